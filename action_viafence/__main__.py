@@ -1,5 +1,6 @@
 from .viafence import *
 from .viafence_dialogs import *
+from .viafence_file import *
 
 import os
 import argparse
@@ -7,44 +8,130 @@ import json
 import numpy as np
 import matplotlib.pyplot as plt
 import wx
-import copy
+import time
+import math
+import multiprocessing
 
 argParser = argparse.ArgumentParser()
 argParser.add_argument("--dialog",      dest="dialog",      metavar="DIALOGNAME", help="Show Dialog with <DIALOGNAME>")
 argParser.add_argument("--runtests",    dest="runtests",    action="store_true", default=0, help="Execute testing all json test files in 'tests' subdirectory")
 argParser.add_argument("--test",        dest="test",        metavar="TESTNAME", help="Loads <TESTNAME> from 'tests' directory, runs it and shows/stores the result into the test file")
+argParser.add_argument("--convert",     dest="convert",     metavar="FILE", nargs="+", help="Converts json test files or debug dumps to the compact binary format and vice versa")
 argParser.add_argument("--store",       dest="store",       action="store_true", default=0, help="When running a test, stores the result as known-good")
 argParser.add_argument("--verbose",     dest="verbose",     action="store_true", default=0, help="Verbose plotting the inner workings of the algorithm")
-args = argParser.parse_args()
-
-def compareTests(testDict, refDict):
-    testPts = testDict['viaPoints']
-    refPts = refDict['viaPoints']
-    matchedPts = [point for point in testPts if point in refPts]
-    return True if len(testPts) == len(refPts) == len(matchedPts) else False
-
+argParser.add_argument("--tolerance",   dest="tolerance",   type=float, default=0, help="Maximum distance between a test and a reference via to be considered equal (default: %(default)s)")
+argParser.add_argument("--jobs",        dest="jobs",        type=int, default=multiprocessing.cpu_count(), help="Number of tests to run in parallel (default: %(default)s)")
+argParser.add_argument("--timefactor",  dest="timefactor",  type=float, default=2.0, help="A test fails if it runs longer than <TIMEFACTOR> times its stored run time plus the time slack (default: %(default)s)")
+argParser.add_argument("--timeslack",   dest="timeslack",   type=float, default=0.05, help="Additional run time in seconds allowed for each test (default: %(default)s)")
+
+# Matches test vias to reference vias within a tolerance using a grid hash
+# Returns the reference vias without a test via and the test vias without a reference via
+def matchViaPoints(testPts, refPts, tolerance):
+    cellSize = max(tolerance, 1e-9)
+    getCell = lambda point: (int(math.floor(point[0] / cellSize)), int(math.floor(point[1] / cellSize)))
+    grid = {}
+    for refIdx, point in enumerate(refPts):
+        grid.setdefault(getCell(point), []).append(refIdx)
+
+    matchedRefIdx = set()
+    extraPts = []
+    for point in testPts:
+        cellX, cellY = getCell(point)
+        candidates = [refIdx for dX in (-1, 0, 1) for dY in (-1, 0, 1) for refIdx in grid.get((cellX+dX, cellY+dY), [])
+                      if refIdx not in matchedRefIdx and getLineLength([point, refPts[refIdx]]) <= tolerance]
+        if len(candidates) > 0:
+            matchedRefIdx.add(min(candidates, key=lambda refIdx: getLineLength([point, refPts[refIdx]])))
+        else:
+            extraPts += [point]
+
+    missingPts = [point for refIdx, point in enumerate(refPts) if refIdx not in matchedRefIdx]
+    return missingPts, extraPts
+
+# Fails if the test took considerably longer than the stored run time of the reference
+# References without a stored run time always pass
+def compareTimes(testDict, refDict, timeFactor, timeSlack):
+    if 'runTime' not in refDict: return True
+    return True if testDict['runTime'] <= refDict['runTime'] * timeFactor + timeSlack else False
+
+# Tests are stored either as json or in the compact binary format (see viafence_file.py)
 def loadTest(testFilename):
+    if isBinaryFile(testFilename): return loadBinaryFile(testFilename)
     with open(testFilename, 'r') as file:
         return json.load(file)
 
 def storeTest(testFilename, testDict):
+    if isBinaryFile(testFilename): return storeBinaryFile(testFilename, testDict)
     with open(testFilename, 'w') as file:
-        json.dump(testDict, file, indent=4, sort_keys=True)
-
-def runTest(testDict, verboseFunc):
+        json.dump(dict(testDict), file, indent=4, sort_keys=True)
+
+# Converts a json file into a binary file and vice versa. Returns the new filename
+def convertTest(testFilename):
+    baseFilename = os.path.splitext(testFilename)[0]
+    newFilename = baseFilename + (".json" if isBinaryFile(testFilename) else binaryExtension)
+    testDict = loadTest(testFilename)
+    storeTest(newFilename, testDict)
+    if isBinaryFile(testFilename): testDict.close()
+    return newFilename
+
+# Runs the algorithm on the test and returns the via points
+def generateTestVias(testDict, verboseFunc):
     viaOffset = testDict['viaOffset']
     viaPitch = testDict['viaPitch']
     pathList = testDict['pathList']
 
-    newDict = copy.deepcopy(testDict)
-    newDict['viaPoints'] = generateViaFence(pathList, viaOffset, viaPitch, verboseFunc)
-
+    if 'layerPathList' in testDict:
+        # Multi-layer dump, replay all layers and merge the vias
+        viaPoints = generateViaFenceMultiLayer(testDict['layerPathList'], viaOffset, viaPitch, vFunc=verboseFunc,
+            layerArcList=testDict.get('layerArcList'))
+    else:
+        viaPoints = generateViaFence(pathList, viaOffset, viaPitch, verboseFunc, arcList=testDict.get('arcList', []))
+
+    if 'zoneList' in testDict:
+        # Fill the zones with stitching vias, keeping clear of the fenced paths
+        arcPathList = [flattenArc(arc, getDefaultArcTolerance(viaOffset)) for arc in testDict.get('arcList', [])]
+        keepoutList = testDict.get('keepoutList', []) + expandPathsToPolygons(pathList, viaOffset, arcPathList)
+        viaPoints += generateViaStitching(testDict['zoneList'], testDict['stitchPitch'], keepoutList,
+            viaPoints, vFunc=verboseFunc)
+
+    return viaPoints
+
+# Runs the test and stores the time it took in 'runTime'
+# The plotting would dominate the run time, so the test is timed without it
+# and run a second time to plot the inner workings when a verboseFunc is given
+def runTest(testDict, verboseFunc = None):
+    newDict = testDict.copy()
+    startTime = time.time()
+    newDict['viaPoints'] = generateTestVias(testDict, lambda *args,**kwargs:None)
+    newDict['runTime'] = time.time() - startTime
+
+    if verboseFunc is not None: generateTestVias(testDict, verboseFunc)
     return newDict
 
-def printTestResult(testName, refDict, testDict):
-    print("{}: {} (Ref/Test Vias: {}/{})".format(
-        testName, "PASSED" if compareTests(refDict, testDict) else "FAILED",
-        len(refDict['viaPoints']), len(testDict['viaPoints']) ))
+# Loads and runs a test file. Used by the parallel test runner
+def runTestFile(testFile, verboseFunc = None):
+    ref = loadTest(testFile)
+    return os.path.basename(testFile), ref, runTest(ref, verboseFunc)
+
+# Prints the test result including the vias that did not match and returns whether the test passed
+def printTestResult(testName, refDict, testDict, args, maxListedVias = 10):
+    missingPts, extraPts = matchViaPoints(testDict['viaPoints'], refDict['viaPoints'], args.tolerance)
+    isViaPassed = len(missingPts) == len(extraPts) == 0
+    isTimePassed = compareTimes(testDict, refDict, args.timefactor, args.timeslack)
+
+    print("{}: {} (Ref/Test Vias: {}/{}, Ref/Test Time: {}/{:.3f}s)".format(
+        testName, "PASSED" if isViaPassed and isTimePassed else "FAILED",
+        len(refDict['viaPoints']), len(testDict['viaPoints']),
+        "{:.3f}".format(refDict['runTime']) if 'runTime' in refDict else "-", testDict['runTime'] ))
+
+    for label, pointList in [("Missing", missingPts), ("Extra", extraPts)]:
+        if len(pointList) > 0:
+            print("    {} vias ({}): {}{}".format(label, len(pointList),
+                ", ".join("({:.3f}, {:.3f})".format(point[0], point[1]) for point in pointList[:maxListedVias]),
+                ", ..." if len(pointList) > maxListedVias else ""))
+    if not isTimePassed:
+        print("    Run time exceeds {:.3f}s".format(refDict['runTime'] * args.timefactor + args.timeslack))
+
+    return isViaPassed and isTimePassed
 
 def verbosePlot(object, isPoints = False, isPaths = False, isPolygons = False):
     import numpy as np
@@ -59,8 +146,9 @@ def verbosePlot(object, isPoints = False, isPaths = False, isPolygons = False):
             plt.plot(data.T[0], data.T[1], linestyle='', marker='x', markersize=10, mew=3)
 
 def main():
+    args = argParser.parse_args()
     testDir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'tests')
-    verboseFunc = verbosePlot if args.verbose else lambda *args,**kwargs:None
+    verboseFunc = verbosePlot if args.verbose else None
 
     if (args.dialog):
         # Load and show dialog
@@ -71,17 +159,25 @@ def main():
         print("Starting wxApp Now. Exit using Ctrl+C")
         app.MainLoop()
 
+    elif (args.convert):
+        for testFile in args.convert:
+            print("{} -> {}".format(testFile, convertTest(testFile)))
+
     elif (args.test):
         # Load a test file, run the algorithm and show/store the result for later testing
         testFile = os.path.join(testDir, args.test) + ".json"
+        if not os.path.exists(testFile): testFile = os.path.join(testDir, args.test) + binaryExtension
         ref = loadTest(testFile)
         test = runTest(ref, verboseFunc)
 
-        printTestResult(args.test, ref, test)
+        printTestResult(args.test, ref, test, args)
 
         if (args.store): storeTest(testFile, test)
 
-        for path in test['pathList']:
+        for zone in test.get('zoneList', []) + test.get('keepoutList', []):
+            plt.fill(np.array(zone).T[0], np.array(zone).T[1], facecolor='grey', alpha=0.3)
+
+        for path in test['pathList'] + [flattenArc(arc, getDefaultArcTolerance(test['viaOffset'])) for arc in test.get('arcList', [])]:
             plt.plot(np.array(path).T[0], np.array(path).T[1], linewidth=5)
 
         for via in test['viaPoints']:
@@ -93,21 +189,29 @@ def main():
         plt.show()
     elif (args.runtests):
         # Run all tests in 'tests' subdirectory
+        # Tests run in parallel unless the inner workings are plotted
         scriptDir = os.path.dirname(os.path.realpath(__file__))
         testDir = scriptDir + "/" + 'tests'
+        testFiles = [os.path.join(testDir, file) for file in sorted(os.listdir(testDir))
+                     if file.endswith(".json") or isBinaryFile(file)]
         testsPassed = 0
         testsTotal = 0
 
-        for file in os.listdir(testDir):
-            if file.endswith(".json"):
-                testName = os.path.basename(file)
-                ref = loadTest(os.path.join(testDir, file))
-                test = runTest(ref, verboseFunc)
+        if (args.verbose) or (args.jobs <= 1):
+            results = [runTestFile(testFile, verboseFunc) for testFile in testFiles]
+        else:
+            pool = multiprocessing.Pool(args.jobs)
+            results = pool.map(runTestFile, testFiles)
+            pool.close()
 
-                printTestResult(testName, ref, test)
+            # Tests running in parallel compete for the CPU, so a test exceeding its
+            # run time is timed again on its own before it is reported as failed
+            results = [result if compareTimes(result[2], result[1], args.timefactor, args.timeslack) else runTestFile(testFile)
+                       for testFile, result in zip(testFiles, results)]
 
-                if compareTests(ref, test): testsPassed += 1
-                testsTotal += 1
+        for testName, ref, test in results:
+            if printTestResult(testName, ref, test, args): testsPassed += 1
+            testsTotal += 1
 
         print("----\n{}/{} tests PASSED".format(testsPassed, testsTotal))
 
@@ -117,4 +221,5 @@ def main():
         else: exit(1)
 
 
-main()
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,30 @@ def verbose(object, *args, **kwargs):
     global verboseFunc
     verboseFunc(object, *args, **kwargs)
 
+# Raised by generateViaFence when the progress callback requests an abort
+class ViaFenceAborted(Exception):
+    pass
+
+def progress(current, total):
+    global progressFunc
+    if progressFunc(current, total) is False:
+        raise ViaFenceAborted()
+
+# All generated coordinates are integer board units (nanometres in pcbnew),
+# so points can be hashed, deduplicated and compared exactly
+def toBoardPoint(point):
+    return [int(round(point[0])), int(round(point[1]))]
+
+# Removes exact duplicates from a list of points while keeping their order
+def getUniquePoints(pointList):
+    pointSet = set()
+    uniquePoints = []
+    for point in pointList:
+        if tuple(point) not in pointSet:
+            pointSet.add(tuple(point))
+            uniquePoints += [point]
+    return uniquePoints
+
 # Returns the slope of a line
 def getLineSlope(line):
     return math.atan2(line[0][1]-line[1][1], line[0][0]-line[1][0])
@@ -15,6 +39,14 @@ def getLineSlope(line):
 def getLineLength(line):
     return math.hypot(line[0][0]-line[1][0], line[0][1]-line[1][1])
 
+# Returns the distance of a point to a line segment
+def getPointLineDistance(point, line):
+    (x1, y1), (x2, y2) = line
+    dx, dy = x2 - x1, y2 - y1
+    lengthSq = float(dx * dx + dy * dy)
+    t = 0 if (lengthSq == 0) else min(1, max(0, ((point[0] - x1) * dx + (point[1] - y1) * dy) / lengthSq))
+    return math.hypot(point[0] - x1 - t * dx, point[1] - y1 - t * dy)
+
 # Returns a sub path in a path with a path specification (startIdx, stopIdx)
 def getSubPath(path, pathSpec):
     listModulus = len(path)
@@ -37,10 +69,16 @@ def splitPathByPaths(path, splitList):
 
 # Return a cumulative distance vector representing the distance travelled along
 # the path at each path vertex
-def getPathCumDist(path):
+# Segments with an entry in the optional arcSegments list (see getPathArcSegments)
+# contribute the length of their arc instead of the chord length
+def getPathCumDist(path, arcSegments = None):
     cumDist = [0.0]
     for vertexId in range(1, len(path)):
-        cumDist += [cumDist[-1] + getLineLength([path[vertexId], path[vertexId-1]])]
+        arcSegment = arcSegments[vertexId-1] if arcSegments is not None else None
+        if arcSegment is not None:
+            cumDist += [cumDist[-1] + arcSegment[1] * abs(arcSegment[3])]
+        else:
+            cumDist += [cumDist[-1] + getLineLength([path[vertexId], path[vertexId-1]])]
 
     return cumDist
 
@@ -114,12 +152,169 @@ class PathInterpolator:
         # Return interpolated coordinates on the original path
         return [self.xInterp(t), self.yInterp(t)]
 
+# Interpolate a path with (x,y) vertices using its arc length t (see getPathCumDist)
+# Segments with an entry in arcSegments follow their circle instead of the chord
+class ArcPathInterpolator:
+    def __init__(self, t, path, arcSegments):
+        self.t, self.path, self.arcSegments = t, path, arcSegments
+        self.linearInterp = PathInterpolator(t, path)
+    def __call__(self, t):
+        i = min(max(bisect_left(self.t, t) - 1, 0), len(self.path) - 2)
+        arcSegment = self.arcSegments[i]
+        if arcSegment is None:
+            return self.linearInterp(t)
+
+        center, radius, startAngle, deltaAngle = arcSegment
+        angle = startAngle + deltaAngle * (t - self.t[i]) / (self.t[i+1] - self.t[i])
+        return [center[0] + radius * math.cos(angle), center[1] + radius * math.sin(angle)]
+
+# Arcs are given as [center, start, angle] with the angle in degrees (positive is
+# counter-clockwise in a y-up coordinate system, i.e. clockwise on the board as in pcbnew)
+# An optional fourth item gives the exact end point, so the flattened arc ends exactly
+# where connected paths start even if the center and angle are not exact
+# The maximum angle in degrees covered by a single segment of a flattened arc. This is
+# kept well below the bend tolerance used for fixed vias so arcs never produce fixed vias
+arcMaxStepAngle = 5.0
+
+# Flattened arcs are cached per arc and tolerance. The cache is cleared by each
+# generateViaFence call, so it only holds the arcs of the most recent via fence
+arcCache = {}
+
+# The default arc flattening tolerance is 1% of the via offset in board units
+def getDefaultArcTolerance(viaOffset):
+    return max(1, int(viaOffset) // 100)
+
+def getArcRadius(arc):
+    return getLineLength([arc[0], arc[1]])
+
+def getArcStartAngle(arc):
+    return math.atan2(arc[1][1] - arc[0][1], arc[1][0] - arc[0][0])
+
+# Returns the arc [center, start, angle, end] running from start through mid to end
+# The center is rounded to board units. Returns None if the points are collinear,
+# i.e. the arc is a straight line from start to end
+def getArcFromPoints(start, mid, end):
+    # Center is the intersection of the perpendicular bisectors of start-mid and mid-end
+    ax, ay = mid[0] - start[0], mid[1] - start[1]
+    bx, by = end[0] - start[0], end[1] - start[1]
+    det = 2.0 * (ax * by - ay * bx)
+    if (det == 0): return None
+    lenA, lenB = ax * ax + ay * ay, bx * bx + by * by
+    center = toBoardPoint([start[0] + (by * lenA - ay * lenB) / det, start[1] + (ax * lenB - bx * lenA) / det])
+
+    # The arc runs in the direction that passes through the mid point
+    startAngle = math.atan2(start[1] - center[1], start[0] - center[0])
+    midAngle = (math.atan2(mid[1] - center[1], mid[0] - center[0]) - startAngle) % (2 * math.pi)
+    endAngle = (math.atan2(end[1] - center[1], end[0] - center[0]) - startAngle) % (2 * math.pi)
+    angle = endAngle if midAngle <= endAngle else endAngle - 2 * math.pi
+    return [center, list(start), angle * 180 / math.pi, list(end)]
+
+# Flattens an arc into a polyline whose segments deviate from the arc
+# by no more than tolerance (the sagitta of each segment), but at least uses
+# one segment per arcMaxStepAngle. The start (and end if given) vertex is kept
+# as is, all other vertices are rounded to integer board units
+# Returns a new list, so the caller may modify it without affecting the cache
+def flattenArc(arc, tolerance):
+    key = (tuple(arc[0]), tuple(arc[1]), arc[2], tuple(arc[3]) if len(arc) > 3 else None, tolerance)
+    if key not in arcCache:
+        radius = getArcRadius(arc)
+        angle = arc[2] * math.pi / 180
+        startAngle = getArcStartAngle(arc)
+        maxStepAngle = arcMaxStepAngle * math.pi / 180
+        if (tolerance < radius): maxStepAngle = min(maxStepAngle, 2 * math.acos(1 - float(tolerance) / radius))
+        nSteps = max(1, int(math.ceil(abs(angle) / maxStepAngle)))
+
+        arcCache[key] = [list(arc[1])] + [
+            toBoardPoint([ arc[0][0] + radius * math.cos(startAngle + angle * step / nSteps),
+                           arc[0][1] + radius * math.sin(startAngle + angle * step / nSteps) ])
+            for step in range(1, nSteps+1)]
+        if len(arc) > 3: arcCache[key][-1] = list(arc[3])
+
+    return [list(vertex) for vertex in arcCache[key]]
+
+# Returns the two circles [center, radius, startAngle, angle, tolerance] running
+# parallel to each arc at the given offset. The tolerance is the maximum distance of
+# the vertices and segment midpoints of the offset flattened arc to the true circle
+def getArcOffsetCircles(arcList, offset, arcTolerance):
+    # Mitered joins of the flattened arc place vertices slightly outside the circle
+    miterDeviation = offset * (1 / math.cos(arcMaxStepAngle * math.pi / 360) - 1)
+    circleList = []
+    for arc in arcList:
+        radius = getArcRadius(arc)
+        for circleRadius in [radius + offset, radius - offset]:
+            if (circleRadius > 0):
+                tolerance = arcTolerance * circleRadius / radius + miterDeviation + 2
+                circleList += [[arc[0], circleRadius, getArcStartAngle(arc), arc[2] * math.pi / 180, tolerance]]
+
+    return circleList
+
+# Returns whether the point lies on the given circle (see getArcOffsetCircles)
+def isPointOnArcCircle(point, circle):
+    center, radius, startAngle, angle, tolerance = circle
+    if (abs(getLineLength([point, center]) - radius) > tolerance): return False
+
+    # Check that the point is within the angular span of the arc. Vertices where
+    # the arc joins other paths may lie up to one flattening step outside of it
+    pointAngle = math.atan2(point[1] - center[1], point[0] - center[0])
+    spanAngle = (pointAngle - startAngle) * (1 if angle >= 0 else -1) % (2 * math.pi)
+    margin = max(tolerance / radius, arcMaxStepAngle * math.pi / 180)
+    return (spanAngle <= abs(angle) + margin) or (spanAngle >= 2 * math.pi - margin)
+
+# A grid hash of the circles (see getArcOffsetCircles) so that a point only has to be
+# checked against the circles running close by. Each circle is sampled along its angular
+# span (including the margins of isPointOnArcCircle) at least every cellSize and registered
+# in the cell of each sample. Any point on the circle is then in a neighbouring cell of a sample
+class ArcCircleGrid(object):
+    def __init__(self, circleList, cellSize):
+        self.circleList = circleList
+        self.cellSize = float(max([cellSize] + [circle[4] for circle in circleList]))
+        self.grid = {}
+        for circleIdx, (center, radius, startAngle, angle, tolerance) in enumerate(circleList):
+            margin = max(tolerance / radius, arcMaxStepAngle * math.pi / 180)
+            spanAngle = (abs(angle) + 2 * margin) * (1 if angle >= 0 else -1)
+            fromAngle = startAngle - margin * (1 if angle >= 0 else -1)
+            nSteps = max(1, int(math.ceil(abs(spanAngle) * radius / self.cellSize)))
+            for cell in set(self.getCell([center[0] + radius * math.cos(fromAngle + spanAngle * step / nSteps),
+                                          center[1] + radius * math.sin(fromAngle + spanAngle * step / nSteps)])
+                            for step in range(0, nSteps + 1)):
+                self.grid.setdefault(cell, []).append(circleIdx)
+    def getCell(self, point):
+        return (int(math.floor(point[0] / self.cellSize)), int(math.floor(point[1] / self.cellSize)))
+    def getCircles(self, point):
+        cellX, cellY = self.getCell(point)
+        circleIdxSet = set(circleIdx for dX in (-1, 0, 1) for dY in (-1, 0, 1)
+                           for circleIdx in self.grid.get((cellX+dX, cellY+dY), []))
+        return [self.circleList[circleIdx] for circleIdx in sorted(circleIdxSet)]
+
+# Returns a list with an entry for each segment of the path. The entry is
+# [center, radius, startAngle, deltaAngle] if the segment runs along one of
+# the circles in the given ArcCircleGrid, otherwise None
+def getPathArcSegments(path, circleGrid):
+    arcSegments = [None] * (len(path) - 1)
+
+    for vertexIdx in range(0, len(path) - 1):
+        fromVertex, toVertex = path[vertexIdx], path[vertexIdx+1]
+        midVertex = [(fromVertex[0] + toVertex[0]) / 2.0, (fromVertex[1] + toVertex[1]) / 2.0]
+        for circle in circleGrid.getCircles(midVertex):
+            if all(isPointOnArcCircle(vertex, circle) for vertex in [fromVertex, midVertex, toVertex]):
+                center = circle[0]
+                fromAngle = math.atan2(fromVertex[1] - center[1], fromVertex[0] - center[0])
+                toAngle = math.atan2(toVertex[1] - center[1], toVertex[0] - center[0])
+                deltaAngle = (toAngle - fromAngle + math.pi) % (2 * math.pi) - math.pi
+                arcSegments[vertexIdx] = [center, circle[1], fromAngle, deltaAngle]
+                break
+
+    return arcSegments
+
 # A small pyclipper wrapper class to expand a line to a polygon with a given offset
-def expandPathsToPolygons(pathList, offset):
+# Paths in miterPathList (i.e. flattened arcs) use mitered joins, so that pyclipper
+# does not add round joins with many vertices at each of their shallow bends
+def expandPathsToPolygons(pathList, offset, miterPathList = []):
     # Use PyclipperOffset to generate polygons that surround the original
     # paths with a constant offset all around
     co = pyclipper.PyclipperOffset()
     for path in pathList: co.AddPath(path, pyclipper.JT_ROUND, pyclipper.ET_OPENROUND)
+    for path in miterPathList: co.AddPath(path, pyclipper.JT_MITER, pyclipper.ET_OPENROUND)
     return co.Execute(offset)
 
 # A small pyclipper wrapper to trim parts of a polygon using another polygon
@@ -134,19 +329,31 @@ def unionPolygons(pathList):
     for path in pathList: pc.AddPath(path, pyclipper.PT_SUBJECT, True)
     return pc.Execute(pyclipper.CT_UNION, pyclipper.PFT_NONZERO)
 
+# A small pyclipper wrapper to subtract a list of polygons from another list of polygons
+def subtractPolygons(pathList, clipPathList):
+    pc = pyclipper.Pyclipper()
+    for path in pathList: pc.AddPath(path, pyclipper.PT_SUBJECT, True)
+    for clipPath in clipPathList: pc.AddPath(clipPath, pyclipper.PT_CLIP, True)
+    return pc.Execute(pyclipper.CT_DIFFERENCE, pyclipper.PFT_NONZERO, pyclipper.PFT_NONZERO)
+
+# A small pyclipper wrapper to grow (positive offset) or shrink (negative offset) closed polygons
+def offsetPolygons(pathList, offset):
+    if (offset == 0): return pathList
+    co = pyclipper.PyclipperOffset()
+    for path in pathList: co.AddPath(path, pyclipper.JT_MITER, pyclipper.ET_CLOSEDPOLYGON)
+    return co.Execute(offset)
+
 def isPointInPolygon(point, path):
     return True if (pyclipper.PointInPolygon(point, path) == 1) else False
 
+# The polygon is one of the offset polygons of the paths. A path can not cross its
+# boundary, since the boundary keeps the offset to all paths, so it is enough to
+# check a single vertex of each path
 def getPathsInsidePolygon(pathList, polygon):
     filteredPathList = []
 
     for path in pathList:
-        allVerticesInside = True
-        for vertex in path:
-            if not isPointInPolygon(vertex, polygon):
-                allVerticesInside = False
-                break
-        if (allVerticesInside): filteredPathList += [path]
+        if isPointInPolygon(path[0], polygon): filteredPathList += [path]
 
     return filteredPathList
 
@@ -154,24 +361,31 @@ def getPathsInsidePolygon(pathList, polygon):
 # When the path length is not evenly dividable by the minimumSpacing,
 # the actual spacing will be larger, but still smaller than 2*minimumSpacing
 # The function does not return the start and end vertex of the path
-def distributeAlongPath(path, minimumSpacing):
+# Segments running along one of the circles in the optional ArcCircleGrid
+# are measured by their arc length and the points are placed on the circle
+def distributeAlongPath(path, minimumSpacing, circleGrid = None):
+    arcSegments = getPathArcSegments(path, circleGrid) if circleGrid is not None else None
+    if (arcSegments is not None) and all(arcSegment is None for arcSegment in arcSegments): arcSegments = None
+
     # Get cumulated distance vector for the path
     # and determine the number of points that can fit to the path
-    distList = getPathCumDist(path)
+    distList = getPathCumDist(path, arcSegments)
     nPoints = int(math.floor(distList[-1] / minimumSpacing))
-    ptInterp = PathInterpolator(distList, path)
-    return [ptInterp(ptIdx * distList[-1]/nPoints) for ptIdx in range(1, nPoints)]
+    ptInterp = PathInterpolator(distList, path) if arcSegments is None else ArcPathInterpolator(distList, path, arcSegments)
+    return [toBoardPoint(ptInterp(ptIdx * distList[-1]/nPoints)) for ptIdx in range(1, nPoints)]
 
 # Find the leaf vertices in a list of paths,
 # additionally it calculates the slope of the line connected to the leaf vertex
 def getLeafVertices(pathList):
-    allVertices = [vertex for path in pathList for vertex in path]
+    vertexCount = {}
+    for vertex in [tuple(vertex) for path in pathList for vertex in path]:
+        vertexCount[vertex] = vertexCount.get(vertex, 0) + 1
     leafVertices = []
     leafVertexSlopes = []
 
     for path in pathList:
         for vertexIdx in [0,-1]:
-            if (allVertices.count(path[vertexIdx]) == 1):
+            if (vertexCount[tuple(path[vertexIdx])] == 1):
                 # vertex appears only once in entire path list, store away
                 # Get neighbour vertex and also calculate the slope
                 leafVertex = path[vertexIdx]
@@ -181,18 +395,22 @@ def getLeafVertices(pathList):
 
     return leafVertices, leafVertexSlopes
 
-# Rotate and Translate a list of vertices using a given angle and offset
-def transformVertices(vertexList, offset, angle):
-    return [ [ round(offset[0] + math.cos(angle) * vertex[0] - math.sin(angle) * vertex[1]),
-               round(offset[1] + math.sin(angle) * vertex[0] + math.cos(angle) * vertex[1]) ]
-           for vertex in vertexList]
+# Returns the trim polygons used to cut a flush end at each of the given vertices
+# The sine and cosine of each slope are only computed once per vertex
+def getTrimPolygons(vertexList, vertexSlopes, radius):
+    trimPoly = [ [0, -radius], [0, 0], [0, radius], [-0.414*radius, radius], [-radius, 0.414*radius],
+                 [-radius, -0.414*radius], [-0.414*radius, -radius] ]
+    rotations = [(math.cos(slope), math.sin(slope)) for slope in vertexSlopes]
+    return [ [ toBoardPoint([ offset[0] + cosA * vertex[0] - sinA * vertex[1],
+                              offset[1] + sinA * vertex[0] + cosA * vertex[1] ])
+               for vertex in trimPoly ]
+             for offset, (cosA, sinA) in zip(vertexList, rotations) ]
 
 # Trims a polygon flush around the given vertices
 def trimFlushPolygonAtVertices(path, vertexList, vertexSlopes, radius):
-    trimPoly = [ [0, -radius], [0, 0], [0, radius], [-0.414*radius, radius], [-radius, 0.414*radius],
-                 [-radius, -0.414*radius], [-0.414*radius, -radius] ]
-    trimPolys = [transformVertices(trimPoly, vertexPos, vertexSlope)
-        for vertexPos, vertexSlope in zip(vertexList, vertexSlopes)]
+    if len(vertexList) == 0: return [path] # Closed loops do not have any leaf vertices
+
+    trimPolys = getTrimPolygons(vertexList, vertexSlopes, radius)
 
     trimPolys = unionPolygons(trimPolys)
 
@@ -200,37 +418,65 @@ def trimFlushPolygonAtVertices(path, vertexList, vertexSlopes, radius):
 
     return clipPolygonWithPolygons(path, trimPolys)
 
-
-
 ######################
-def generateViaFence(pathList, viaOffset, viaPitch, vFunc = lambda *args,**kwargs:None):
-    global verboseFunc
+# The optional pFunc is called with (current, total) after each offset polygon has
+# been collected and after each via fence component has been processed.
+# Returning False from it aborts with ViaFenceAborted
+# Arcs in arcList are flattened with arcTolerance (see getDefaultArcTolerance)
+# and vias next to them are placed on the exact offset circle
+# The returned vias are unique and in integer board units
+def generateViaFence(pathList, viaOffset, viaPitch, vFunc = lambda *args,**kwargs:None, pFunc = lambda *args,**kwargs:None,
+                     arcList = [], arcTolerance = None):
+    global verboseFunc, progressFunc, arcCache
     verboseFunc = vFunc
+    progressFunc = pFunc
+    arcCache = {}
     viaPoints = []
+    arcTolerance = getDefaultArcTolerance(viaOffset) if arcTolerance is None else arcTolerance
 
-    # Remove zero length tracks
+    # Remove zero length tracks and arcs
     pathList = [path for path in pathList if getLineLength(path) > 0]
+    arcList = [arc for arc in arcList if (getArcRadius(arc) > 0) and (arc[2] != 0)]
+    arcPathList = [flattenArc(arc, arcTolerance) for arc in arcList]
+    arcCircleList = getArcOffsetCircles(arcList, viaOffset, arcTolerance)
+    arcCircleGrid = ArcCircleGrid(arcCircleList, viaOffset) if len(arcCircleList) > 0 else None
 
     # Expand the paths given as a parameter into one or more polygons
     # using the offset parameter
-    for offsetPoly in expandPathsToPolygons(pathList, viaOffset):
+    offsetPolyList = expandPathsToPolygons(pathList, viaOffset, arcPathList)
+    pathList = pathList + arcPathList
+
+    # Filter the input path to only include paths inside each polygon
+    # Find all leaf vertices and use them to trim the expanded polygons
+    # around the leaf vertices so that we get a flush, flat end
+    # These butt lines are then found using the leaf vertices
+    # and used to split open the polygon into multiple separate open
+    # paths that envelop the original path
+    # The progress counts one step for each polygon while collecting the components
+    # and one step for each component while placing the vias
+    componentList = []
+    for offsetPolyIdx, offsetPoly in enumerate(offsetPolyList):
         verbose([offsetPoly], isPolygons=True)
-        # Filter the input path to only include paths inside this polygon
-        # Find all leaf vertices and use them to trim the expanded polygon
-        # around the leaf vertices so that we get a flush, flat end
-        # These butt lines are then found using the leaf vertices
-        # and used to split open the polygon into multiple separate open
-        # paths that envelop the original path
         localPathList = getPathsInsidePolygon(pathList, offsetPoly)
-        if len(localPathList) == 0: continue # This might happen with very bad input paths
+        # This might not be the case with very bad input paths or with the
+        # holes inside of closed loops, which are fenced as a whole
+        if (len(localPathList) > 0) or not pyclipper.Orientation(offsetPoly):
+            componentList += [[offsetPoly] + list(getLeafVertices(localPathList))]
+        progress(offsetPolyIdx+1, 2*len(offsetPolyList))
+
+    progressOffset = len(offsetPolyList)
+    progressTotal = progressOffset + len(componentList)
 
-        leafVertexList, leafVertexAngles = getLeafVertices(localPathList)
+    for componentIdx, (offsetPoly, leafVertexList, leafVertexAngles) in enumerate(componentList):
         offsetPoly = trimFlushPolygonAtVertices(offsetPoly, leafVertexList, leafVertexAngles, 1.1*viaOffset)[0]
         buttLineIdxList = getPathsThroughPoints(offsetPoly, leafVertexList)
-        fencePaths = splitPathByPaths(offsetPoly, buttLineIdxList)
+        if len(buttLineIdxList) > 0:
+            fencePaths = splitPathByPaths(offsetPoly, buttLineIdxList)
+        else:
+            fencePaths = [offsetPoly + offsetPoly[:1]] # Closed loops are fenced all around
 
         verbose([offsetPoly], isPolygons=True)
-        verbose([leafVertexList], isPoints=True)
+        if len(leafVertexList) > 0: verbose([leafVertexList], isPoints=True)
         verbose(fencePaths, isPaths=True)
 
         # With the now separated open paths we perform via placement on each one of them
@@ -247,8 +493,166 @@ def generateViaFence(pathList, viaOffset, viaPitch, vFunc = lambda *args,**kwarg
             # Then we autoplace vias between the fixed via locations by satisfying the
             # minimum via pitch given by the user
             for subPath in splitPathByPoints(fencePath, fixPointIdxList):
-                viaPoints += distributeAlongPath(subPath, viaPitch)
-
-    return viaPoints
+                viaPoints += distributeAlongPath(subPath, viaPitch, arcCircleGrid)
+
+        progress(progressOffset+componentIdx+1, progressTotal)
+
+    return getUniquePoints(viaPoints)
+
+
+
+# Returns a progress function that maps the progress of a single step
+# onto the overall progress of stepCount steps reported to pFunc
+def getStepProgressFunc(pFunc, step, stepCount):
+    return lambda current, total: pFunc(step * 1000 + (1000 * current) // max(total, 1), stepCount * 1000)
+
+# Merges the via lists of multiple layers into a single list. Vias closer than
+# minDistance to a via of a previously merged layer are dropped, since through vias
+# serve every layer. Vias within a single layer are never removed.
+# The optional layerPathList holds the paths of each layer. Vias closer than
+# pathDistance to a path of another layer are dropped as well, since they would
+# end up on the copper of that layer.
+# Grid hashes are used so each via only has to be checked against the vias
+# and the path segments in its neighbouring cells
+def mergeViaPoints(viaPointsList, minDistance, layerPathList = None, pathDistance = 0):
+    if len(viaPointsList) == 1: return list(viaPointsList[0])
+
+    cellSize = float(minDistance)
+    getCell = lambda point: (int(math.floor(point[0] / cellSize)), int(math.floor(point[1] / cellSize)))
+    grid = {}
+    mergedPoints = []
+
+    # The path segments are sampled at least every pathCellSize and each sample is registered
+    # in its cell. Any point closer than pathDistance to a segment is then less than
+    # pathCellSize away from one of its samples, i.e. in a neighbouring cell of the sample
+    pathCellSize = max(2.0 * pathDistance, 1)
+    getPathCell = lambda point: (int(math.floor(point[0] / pathCellSize)), int(math.floor(point[1] / pathCellSize)))
+    pathGrid = {}
+    if (layerPathList is not None) and (pathDistance > 0):
+        for layerIdx, pathList in enumerate(layerPathList):
+            for path in pathList:
+                for line in zip(path[:-1], path[1:]):
+                    nSamples = max(int(math.ceil(getLineLength(line) / pathCellSize)), 1)
+                    cellSet = set(getPathCell([line[0][0] + (line[1][0] - line[0][0]) * sample / float(nSamples),
+                                               line[0][1] + (line[1][1] - line[0][1]) * sample / float(nSamples)])
+                                  for sample in range(0, nSamples + 1))
+                    for cell in cellSet: pathGrid.setdefault(cell, []).append((layerIdx, line))
+
+    viaCount = sum(len(viaPoints) for viaPoints in viaPointsList)
+    viaIdx = 0
+    for layerIdx, viaPoints in enumerate(viaPointsList):
+        layerPoints = []
+        for viaPoint in viaPoints:
+            viaIdx += 1
+            progress(viaIdx, viaCount)
+            if len(pathGrid) > 0:
+                pathCellX, pathCellY = getPathCell(viaPoint)
+                if any((lineLayerIdx != layerIdx) and (getPointLineDistance(viaPoint, line) < pathDistance)
+                       for dX in (-1, 0, 1) for dY in (-1, 0, 1)
+                       for lineLayerIdx, line in pathGrid.get((pathCellX+dX, pathCellY+dY), [])):
+                    continue
+
+            cellX, cellY = getCell(viaPoint)
+            neighbourPoints = [point for dX in (-1, 0, 1) for dY in (-1, 0, 1) for point in grid.get((cellX+dX, cellY+dY), [])]
+            if all(getLineLength([viaPoint, point]) >= minDistance for point in neighbourPoints):
+                layerPoints += [viaPoint]
+
+        # Only make this layer's vias visible to the following layers
+        for viaPoint in layerPoints:
+            grid.setdefault(getCell(viaPoint), []).append(viaPoint)
+        mergedPoints += layerPoints
+
+    return mergedPoints
+
+# Generates a via fence for each path list in layerPathList (one per layer)
+# and merges them into a single via list using mergeViaPoints.
+# Vias of one layer that end up closer than viaOffset to the paths of another
+# layer are dropped. minDistance defaults to the via pitch
+def generateViaFenceMultiLayer(layerPathList, viaOffset, viaPitch, minDistance = None, vFunc = lambda *args,**kwargs:None, pFunc = lambda *args,**kwargs:None,
+                               layerArcList = None, arcTolerance = None):
+    global progressFunc
+    minDistance = viaPitch if minDistance is None else minDistance
+    layerArcList = [[] for pathList in layerPathList] if layerArcList is None else layerArcList
+    arcTolerance = getDefaultArcTolerance(viaOffset) if arcTolerance is None else arcTolerance
+    stepCount = len(layerPathList) + (1 if len(layerPathList) > 1 else 0)
+    layerViaPoints = []
+    layerFencedPathList = []
+
+    for layerIdx, (pathList, arcList) in enumerate(zip(layerPathList, layerArcList)):
+        # Scale the progress of each layer into the overall progress
+        layerViaPoints += [generateViaFence(pathList, viaOffset, viaPitch, vFunc,
+            getStepProgressFunc(pFunc, layerIdx, stepCount), arcList, arcTolerance)]
+        layerFencedPathList += [pathList + [flattenArc(arc, arcTolerance) for arc in arcList
+            if (getArcRadius(arc) > 0) and (arc[2] != 0)]]
+
+    # The flattened arcs deviate from the true arcs by up to the arc tolerance and the vias
+    # are rounded to board units, so vias right on the fence line of another layer are kept
+    progressFunc = getStepProgressFunc(pFunc, stepCount - 1, stepCount)
+    return mergeViaPoints(layerViaPoints, minDistance, layerFencedPathList, viaOffset - 2 * arcTolerance)
+
+# Returns all points of a grid that lie inside a list of closed polygons (even-odd rule)
+# Row n of the grid is located at y = n*rowPitch with points at x = m*pitch, odd rows
+# are shifted by rowShift. Instead of testing every grid point, each polygon edge is
+# intersected with the grid rows it spans once and all grid points between pairs
+# of crossings on a row are emitted directly
+def getGridPointsInPolygons(polygonList, pitch, rowPitch, rowShift = 0):
+    rowCrossings = {}
+    for polygon in polygonList:
+        for vertexIdx in range(0, len(polygon)):
+            (x1, y1), (x2, y2) = polygon[vertexIdx-1], polygon[vertexIdx]
+            if (y1 == y2): continue
+            if (y1 > y2): x1, y1, x2, y2 = x2, y2, x1, y1
+            slope = float(x2 - x1) / (y2 - y1)
+            # Rows within [y1, y2) so that shared vertices are only counted once
+            for row in range(int(math.ceil(float(y1) / rowPitch)), int(math.ceil(float(y2) / rowPitch))):
+                rowCrossings.setdefault(row, []).append(x1 + (row * rowPitch - y1) * slope)
+
+    gridPoints = []
+    for row in sorted(rowCrossings):
+        crossings = sorted(rowCrossings[row])
+        shift = rowShift if (row % 2) else 0
+        for xFrom, xTo in zip(crossings[0::2], crossings[1::2]):
+            gridPoints += [[col * pitch + shift, row * rowPitch]
+                for col in range(int(math.ceil(float(xFrom - shift) / pitch)), int(math.floor(float(xTo - shift) / pitch)) + 1)]
+
+    return gridPoints
 
+######################
+# Generates a grid of stitching vias filling the zone polygons in zoneList.
+# The zones are shrunk and the polygons in keepoutList are grown by viaMargin before
+# the keepouts are removed from the zones. Vias closer than minDistance (defaults to
+# the via pitch) to one of the fenceViaPoints are dropped.
+# The grid is either staggered (triangular) or rectangular and always aligned to the
+# origin so that the via positions do not depend on the zone outline. The via pitch
+# is rounded to board units, so all vias are in integer board units
+def generateViaStitching(zoneList, viaPitch, keepoutList = [], fenceViaPoints = [], viaMargin = 0, minDistance = None,
+                         isStaggered = True, vFunc = lambda *args,**kwargs:None, pFunc = lambda *args,**kwargs:None):
+    global verboseFunc, progressFunc
+    verboseFunc = vFunc
+    progressFunc = pFunc
+    viaPitch = int(round(viaPitch))
+    minDistance = viaPitch if minDistance is None else minDistance
+    progress(0, 3)
+
+    # Determine the area that may be filled with vias
+    stitchPolys = offsetPolygons(zoneList, -viaMargin)
+    keepoutPolys = offsetPolygons(keepoutList, viaMargin)
+    if len(keepoutPolys) > 0: stitchPolys = subtractPolygons(stitchPolys, keepoutPolys)
+    verbose(stitchPolys, isPolygons=True)
+    progress(1, 3)
+
+    # Fill the area with grid points
+    if (isStaggered):
+        gridPoints = getGridPointsInPolygons(stitchPolys, viaPitch, int(round(viaPitch * math.sqrt(3) / 2)), viaPitch // 2)
+    else:
+        gridPoints = getGridPointsInPolygons(stitchPolys, viaPitch, viaPitch)
+    progress(2, 3)
+
+    # Remove grid points too close to the via fence
+    progressFunc = getStepProgressFunc(pFunc, 2, 3)
+    viaPoints = mergeViaPoints([fenceViaPoints, gridPoints], minDistance)[len(fenceViaPoints):]
+    progressFunc = pFunc
+    verbose(viaPoints, isPoints=True)
+    progress(3, 3)
 
+    return viaPoints
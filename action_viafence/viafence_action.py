@@ -5,9 +5,12 @@ import sys
 import re
 import time
 import json
+import threading
+import traceback
 from collections import OrderedDict
 from .viafence import *
 from .viafence_dialogs import *
+from .viafence_file import *
 
 class ViaFenceAction(pcbnew.ActionPlugin):
     # ActionPlugin descriptive information
@@ -19,12 +22,21 @@ class ViaFenceAction(pcbnew.ActionPlugin):
     def dumpJSON(self, file):
         dict = {
             'pathList': self.pathList, 
+            'layerPathList': self.layerPathList,
+            'arcList': self.arcList,
+            'layerArcList': self.layerArcList,
             'viaOffset': self.viaOffset, 
             'viaPitch': self.viaPitch, 
-            'viaPoints': self.viaPoints if hasattr(self, 'viaPoints') else []
+            'viaPoints': self.viaPoints if hasattr(self, 'viaPoints') else [],
+            'runTime': self.runTime if hasattr(self, 'runTime') else None,
+            'error': self.error if hasattr(self, 'error') else None
         }
-        with open(file, 'w') as file:
-            json.dump(dict, file, indent=4, sort_keys=True)
+        if isBinaryFile(file):
+            # Real boards produce large dumps, use the compact binary format
+            storeBinaryFile(file, dict)
+        else:
+            with open(file, 'w') as file:
+                json.dump(dict, file, indent=4, sort_keys=True)
 
     # Return an ordered {layerId: layerName} dict of enabled layers
     def getLayerMap(self):
@@ -73,13 +85,31 @@ class ViaFenceAction(pcbnew.ActionPlugin):
         for subsFrom, subsTo in subsTable.items(): regEx = regEx.replace(subsFrom, subsTo)
         return regEx
 
+    # Returns the arc [center, start, angle] of an arc shaped pcbnew.BOARD_ITEM
+    # or None if the arc is a straight line
+    def arcFromBoardItem(self, arcObject):
+        if hasattr(arcObject, 'GetMid'):
+            # Arc tracks are defined by three points
+            return getArcFromPoints([arcObject.GetStart()[0], arcObject.GetStart()[1]],
+                                    [arcObject.GetMid()[0],   arcObject.GetMid()[1]],
+                                    [arcObject.GetEnd()[0],   arcObject.GetEnd()[1]])
+
+        # Drawing arcs have a center, a start point and an angle in 0.1 degrees
+        # The end point is passed along so the arc connects exactly to other items
+        return [ [arcObject.GetCenter()[0],   arcObject.GetCenter()[1]],
+                 [arcObject.GetArcStart()[0], arcObject.GetArcStart()[1]],
+                 arcObject.GetAngle() / 10.0,
+                 [arcObject.GetArcEnd()[0],   arcObject.GetArcEnd()[1]] ]
+
+    # The via points are integer board units and are passed to pcbnew as they are
     def createVias(self, viaPoints, viaDrill, viaSize, netCode):
         newVias = []
+        wxPoint = pcbnew.wxPoint
         for viaPoint in viaPoints:
             newVia = pcbnew.VIA(self.boardObj)
             self.boardObj.Add(newVia)
 
-            newVia.SetPosition(pcbnew.wxPoint(viaPoint[0], viaPoint[1]))
+            newVia.SetPosition(wxPoint(viaPoint[0], viaPoint[1]))
             newVia.SetWidth(viaSize)
             newVia.SetDrill(viaDrill)
             newVia.SetViaType(pcbnew.VIA_THROUGH)
@@ -88,9 +118,55 @@ class ViaFenceAction(pcbnew.ActionPlugin):
 
         return newVias
 
+    # Runs generateViaFence in a worker thread while the UI thread shows a progress dialog
+    # Sets self.viaPoints (None on error or abort), self.runTime and self.error
+    def generateViaFenceWithProgress(self):
+        state = {'current': 0, 'total': 1}
+        abortEvent = threading.Event()
+        result = {'viaPoints': None, 'error': None}
+
+        def progressFunc(current, total):
+            state['current'], state['total'] = current, max(total, 1)
+            return not abortEvent.is_set()
+
+        def worker():
+            try:
+                result['viaPoints'] = generateViaFenceMultiLayer(self.layerPathList, self.viaOffset, self.viaPitch,
+                    pFunc=progressFunc, layerArcList=self.layerArcList)
+            except ViaFenceAborted:
+                pass
+            except Exception:
+                result['error'] = traceback.format_exc()
+
+        progressDlg = wx.ProgressDialog(self.name, "Generating via fence...", maximum=1000, parent=None,
+            style=wx.PD_APP_MODAL|wx.PD_CAN_ABORT|wx.PD_ELAPSED_TIME|wx.PD_AUTO_HIDE)
+
+        startTime = time.time()
+        workerThread = threading.Thread(target=worker)
+        workerThread.daemon = True
+        workerThread.start()
+
+        try:
+            while workerThread.is_alive():
+                value = min(999, 1000 * state['current'] // state['total'])
+                # Keep showing that we abort until the worker thread has stopped
+                message = "Aborting..." if abortEvent.is_set() else "Generating via fence ({}%)...".format(value // 10)
+                keepGoing = progressDlg.Update(value, message)[0]
+                if not keepGoing and not abortEvent.is_set():
+                    abortEvent.set()
+                    progressDlg.Update(value, "Aborting...")
+                workerThread.join(0.05)
+        finally:
+            progressDlg.Destroy()
+
+        self.runTime = time.time() - startTime
+        self.error = result['error']
+        self.viaPoints = result['viaPoints']
+
     def selfToMainDialog(self):
-        self.mainDlg.lstLayer.SetItems(self.layerMap.values())
-        self.mainDlg.lstLayer.SetSelection(self.layerId)
+        self.mainDlg.lstLayer.SetItems(list(self.layerMap.values()))
+        for layerIdx, layerId in enumerate(self.layerMap.keys()):
+            self.mainDlg.lstLayer.Check(layerIdx, layerId in self.layerIdList)
         self.mainDlg.txtNetFilter.SetItems(self.netFilterList)
         self.mainDlg.txtNetFilter.SetSelection(self.netFilterList.index(self.netFilter))
         self.mainDlg.txtViaOffset.SetValue(str(pcbnew.ToMM(self.viaOffset)))
@@ -110,7 +186,7 @@ class ViaFenceAction(pcbnew.ActionPlugin):
 
     def mainDialogToSelf(self):
         self.netFilter = self.mainDlg.txtNetFilter.GetValue()
-        self.layerId = self.layerMap.keys()[self.mainDlg.lstLayer.GetSelection()]
+        self.layerIdList = [layerId for layerIdx, layerId in enumerate(self.layerMap.keys()) if self.mainDlg.lstLayer.IsChecked(layerIdx)]
         self.viaOffset = pcbnew.FromMM(float(self.mainDlg.txtViaOffset.GetValue()))
         self.viaPitch = pcbnew.FromMM(float(self.mainDlg.txtViaPitch.GetValue()))
         self.viaDrill = pcbnew.FromMM(float(self.mainDlg.txtViaDrill.GetValue()))
@@ -133,7 +209,7 @@ class ViaFenceAction(pcbnew.ActionPlugin):
         self.netFilterList = self.createNetFilterSuggestions()
         self.netFilter = self.netMap[self.highlightedNetId].GetNetname() if self.highlightedNetId != -1 else self.netFilterList[0]
         self.viaSize = self.boardDesignSettingsObj.GetCurrentViaSize()
-        self.layerId = 0 #TODO: How to get currently selected layer?
+        self.layerIdList = [0] #TODO: How to get currently selected layer?
         self.viaDrill = self.boardDesignSettingsObj.GetCurrentViaDrill()
         self.viaPitch = pcbnew.FromMM(1)
         self.viaOffset = pcbnew.FromMM(1)
@@ -151,8 +227,10 @@ class ViaFenceAction(pcbnew.ActionPlugin):
         if (self.mainDlg.ShowModal() == wx.ID_OK):
             # User pressed OK.
             # Assemble a list of pcbnew.BOARD_ITEMs derived objects that support GetStart/GetEnd and IsOnLayer
+            # Arc shaped objects are collected separately so they can be handled without tessellation
             self.mainDialogToSelf()
             lineObjects = []
+            arcObjects = []
 
             # Do we want to include net tracks?
             if (self.isNetFilterChecked):
@@ -161,7 +239,11 @@ class ViaFenceAction(pcbnew.ActionPlugin):
                 for netId in self.netMap:
                     if re.match(netRegex, self.netMap[netId].GetNetname()):
                         for trackObject in self.boardObj.TracksInNet(netId):
-                            lineObjects += [trackObject]
+                            if hasattr(trackObject, 'GetMid'):
+                                # An arc track
+                                arcObjects += [trackObject]
+                            else:
+                                lineObjects += [trackObject]
 
             # Do we want to include drawing segments?
             if (self.isIncludeDrawingChecked):
@@ -173,30 +255,60 @@ class ViaFenceAction(pcbnew.ActionPlugin):
                         if drawingObject.GetShape() == pcbnew.S_SEGMENT:
                             # A straight line
                             lineObjects += [drawingObject]
+                        elif drawingObject.GetShape() == pcbnew.S_ARC:
+                            # An arc
+                            arcObjects += [drawingObject]
 
                     boardItem = boardItem.Next()
 
             # Do we want to filter the generated lines by layer?
             if (self.isLayerChecked):
-                # Filter by layer
-                # TODO: Make layer selection also a regex
-                lineObjects = [lineObject for lineObject in lineObjects if lineObject.IsOnLayer(self.layerId)]
+                # Filter by layer, each selected layer gets its own list of lines.
+                # The resulting via fences are merged into one set of through vias later on
+                layerLineObjects = [[lineObject for lineObject in lineObjects if lineObject.IsOnLayer(layerId)]
+                                    for layerId in self.layerIdList]
+                layerArcObjects = [[arcObject for arcObject in arcObjects if arcObject.IsOnLayer(layerId)]
+                                   for layerId in self.layerIdList]
+            else:
+                layerLineObjects = [lineObjects]
+                layerArcObjects = [arcObjects]
+
+            # Generate a path list for each layer from the pcbnew.BOARD_ITEM objects
+            self.layerPathList = [[ [ [lineObject.GetStart()[0], lineObject.GetStart()[1]],
+                                      [lineObject.GetEnd()[0],   lineObject.GetEnd()[1]]   ]
+                                    for lineObject in lineObjects]
+                                  for lineObjects in layerLineObjects]
+            self.layerArcList = [[] for arcObjects in layerArcObjects]
+            for pathList, arcList, arcObjects in zip(self.layerPathList, self.layerArcList, layerArcObjects):
+                for arcObject in arcObjects:
+                    arc = self.arcFromBoardItem(arcObject)
+                    if arc is not None:
+                        arcList += [arc]
+                    else:
+                        # A straight arc track (start, mid and end on a line) is handled like a line
+                        pathList += [[ [arcObject.GetStart()[0], arcObject.GetStart()[1]],
+                                       [arcObject.GetEnd()[0],   arcObject.GetEnd()[1]]   ]]
+            self.pathList = [path for pathList in self.layerPathList for path in pathList]
+            self.arcList = [arc for arcList in self.layerArcList for arc in arcList]
+
+            # Generate via fence in the background
+            self.generateViaFenceWithProgress()
 
-            # Generate a path list from the pcbnew.BOARD_ITEM objects
-            self.pathList =  [[ [lineObject.GetStart()[0], lineObject.GetStart()[1]],
-                                [lineObject.GetEnd()[0],   lineObject.GetEnd()[1]]   ]
-                                for lineObject in lineObjects]
+            if (self.isDebugDumpChecked):
+                self.dumpJSON(os.path.join(self.boardPath, time.strftime("viafence-%Y%m%d-%H%M%S") + binaryExtension))
 
-            # Generate via fence
-            try:
-                viaPoints = generateViaFence(self.pathList, self.viaOffset, self.viaPitch)
-            except:
-                viaPoints = []
+            if (self.error is not None):
+                wx.MessageBox("Via fence generation failed after {:.2f}s:\n\n{}".format(self.runTime, self.error),
+                    self.name, wx.OK|wx.ICON_ERROR)
+                return
 
-            if (self.isDebugDumpChecked):
-                self.dumpJSON(os.path.join(self.boardPath, time.strftime("viafence-%Y%m%d-%H%M%S.json")))
+            if (self.viaPoints is None):
+                # User aborted, leave the board untouched
+                return
 
-            viaObjList = self.createVias(viaPoints, self.viaDrill, self.viaSize, self.viaNetId)
+            viaObjList = self.createVias(self.viaPoints, self.viaDrill, self.viaSize, self.viaNetId)
+            wx.MessageBox("Placed {} vias in {:.2f}s.".format(len(viaObjList), self.runTime),
+                self.name, wx.OK|wx.ICON_INFORMATION)
 
 # TODO: Implement
 #            if (self.isRemoveViasWithClearanceViolationChecked):
@@ -126,8 +126,7 @@ class MainDialogBase ( wx.Dialog ):
 		fgSizer31.Add( self.chkLayer, 1, wx.ALL|wx.EXPAND, 5 )
 		
 		lstLayerChoices = []
-		self.lstLayer = wx.Choice( sbSizer411.GetStaticBox(), wx.ID_ANY, wx.DefaultPosition, wx.DefaultSize, lstLayerChoices, 0 )
-		self.lstLayer.SetSelection( 0 )
+		self.lstLayer = wx.CheckListBox( sbSizer411.GetStaticBox(), wx.ID_ANY, wx.DefaultPosition, wx.DefaultSize, lstLayerChoices, 0 )
 		self.lstLayer.Enable( False )
 		
 		fgSizer31.Add( self.lstLayer, 1, wx.ALL|wx.EXPAND, 5 )
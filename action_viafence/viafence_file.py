@@ -0,0 +1,221 @@
+# Compact binary storage for via fence tests and debug dumps
+# The file layout is:
+#   8 bytes magic, 4 bytes header length (little endian), header (JSON), padding, data
+# Nested lists of numbers (pathList, viaPoints, ...) are stored as flat little endian
+# int64 or float64 arrays in the data section, each aligned to 8 bytes. The nesting
+# is described in the header by the lengths of the lists on each level. Lists mixing
+# integers and floats are split into an int64 and a float64 array (plus an array with
+# the positions of the integers), so both keep their type and value.
+# All other values are stored in the header as plain JSON.
+# Files are memory mapped and each array is only decoded when its key is accessed.
+import json
+import mmap
+import os
+import struct
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+binaryMagic = b'VIAFENCE'
+binaryExtension = '.vfb'
+binaryVersion = 2
+
+def isBinaryFile(filename):
+    return filename.endswith(binaryExtension)
+
+def isNumber(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+# Returns the depth at which a nested list contains its numbers
+# or None if the value is not a nested list with all numbers at the same depth
+def getNumberListDepth(value):
+    if not isinstance(value, list): return None
+    depthSet = set()
+    stack = [(value, 1)]
+    while len(stack) > 0:
+        item, depth = stack.pop()
+        for child in item:
+            if isNumber(child): depthSet.add(depth)
+            elif isinstance(child, list): stack += [(child, depth + 1)]
+            else: return None
+        if len(depthSet) > 1: return None
+
+    # Empty lists may appear at any level above the numbers
+    maxDepth = max(depthSet) if len(depthSet) > 0 else 1
+    stack = [(value, 1)]
+    while len(stack) > 0:
+        item, depth = stack.pop()
+        if (depth > maxDepth): return None
+        stack += [(child, depth + 1) for child in item if isinstance(child, list)]
+    return maxDepth
+
+# Integers beyond 64 bits are stored as float64
+def isInt64(number):
+    return isinstance(number, int) and -2**63 <= number < 2**63
+
+# Packs a list of numbers as int64 if possible, otherwise as float64
+def packNumbers(numberList):
+    if all(isInt64(number) for number in numberList):
+        return 'q', struct.pack('<{}q'.format(len(numberList)), *numberList)
+    return 'd', struct.pack('<{}d'.format(len(numberList)), *numberList)
+
+def storeBinaryFile(filename, dict):
+    header = {'version': binaryVersion, 'values': {}, 'arrays': {}}
+    blobList = []
+    dataSize = [0]
+
+    def addBlob(numberList):
+        intIdxList = [numberIdx for numberIdx, number in enumerate(numberList) if isInt64(number)]
+        if (0 < len(intIdxList) < len(numberList)):
+            intIdxSet = set(intIdxList)
+            return {'type': 'mixed', 'count': len(numberList), 'intIdx': addBlob(intIdxList),
+                    'ints': addBlob([numberList[numberIdx] for numberIdx in intIdxList]),
+                    'floats': addBlob([number for numberIdx, number in enumerate(numberList) if numberIdx not in intIdxSet])}
+
+        typeCode, blob = packNumbers(numberList)
+        descriptor = {'type': typeCode, 'offset': dataSize[0], 'count': len(numberList)}
+        blobList.append(blob)
+        dataSize[0] += len(blob)
+        return descriptor
+
+    for key, value in dict.items():
+        depth = getNumberListDepth(value)
+        if depth is None:
+            header['values'][key] = value
+            continue
+
+        # Walk the nested list level by level, recording the list lengths on each level
+        lengthList = []
+        levelItems = [value]
+        for level in range(0, depth):
+            lengths = [len(item) for item in levelItems]
+            if (len(set(lengths)) <= 1):
+                lengthList += [{'uniform': lengths[0] if len(lengths) > 0 else 0, 'count': len(lengths)}]
+            else:
+                lengthList += [addBlob(lengths)]
+            levelItems = [child for item in levelItems for child in item]
+
+        header['arrays'][key] = {'lengths': lengthList, 'numbers': addBlob(levelItems)}
+
+    # All values have been read at this point. A file that is still mapped cannot be
+    # overwritten on Windows, so the mapping is closed when storing to the same file
+    if isinstance(dict, BinaryFileDict) and (os.path.abspath(dict.filename) == os.path.abspath(filename)):
+        dict.close()
+
+    headerBlob = json.dumps(header, sort_keys=True).encode('utf-8')
+    padding = b'\0' * (-(len(binaryMagic) + 4 + len(headerBlob)) % 8)
+
+    with open(filename, 'wb') as file:
+        file.write(binaryMagic + struct.pack('<I', len(headerBlob)) + headerBlob + padding)
+        for blob in blobList: file.write(blob)
+
+def loadBinaryFile(filename):
+    return BinaryFileDict(filename)
+
+# A dict-like view of a binary file that decodes arrays on first access
+# Values that are set are kept in memory and do not modify the file
+# The file stays mapped until close() is called or the with block is left
+class BinaryFileDict(MutableMapping):
+    def __init__(self, filename, overrides = None, _mapping = None):
+        self.filename = filename
+        self.overrides = {} if overrides is None else overrides
+        self.cache = {}
+
+        if _mapping is None:
+            with open(filename, 'rb') as file:
+                self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            if (self.map[0:len(binaryMagic)] != binaryMagic):
+                raise ValueError("{} is not a via fence binary file".format(filename))
+            headerSize = struct.unpack_from('<I', self.map, len(binaryMagic))[0]
+            headerStart = len(binaryMagic) + 4
+            self.header = json.loads(self.map[headerStart:headerStart + headerSize].decode('utf-8'))
+            if (self.header['version'] > binaryVersion):
+                raise ValueError("{} has unsupported version {}".format(filename, self.header['version']))
+            self.dataStart = headerStart + headerSize + (-(headerStart + headerSize) % 8)
+            self.removed = set()
+        else:
+            self.map, self.header, self.dataStart, self.removed = _mapping
+
+    def unpackArray(self, descriptor):
+        if descriptor['type'] == 'mixed':
+            # Put the integers back to their positions and fill the gaps with the floats
+            numberList = [None] * descriptor['count']
+            for numberIdx, number in zip(self.unpackArray(descriptor['intIdx']), self.unpackArray(descriptor['ints'])):
+                numberList[numberIdx] = number
+            floatIter = iter(self.unpackArray(descriptor['floats']))
+            return [next(floatIter) if number is None else number for number in numberList]
+
+        return list(struct.unpack_from('<{}{}'.format(descriptor['count'], descriptor['type']),
+            self.map, self.dataStart + descriptor['offset']))
+
+    def decodeArray(self, arrayInfo):
+        # Rebuild the nested list bottom up, starting at the numbers
+        items = self.unpackArray(arrayInfo['numbers'])
+        for lengthInfo in reversed(arrayInfo['lengths']):
+            if 'uniform' in lengthInfo:
+                length = lengthInfo['uniform']
+                items = [items[itemIdx:itemIdx + length] for itemIdx in range(0, length * lengthInfo['count'], max(length, 1))] \
+                    if length > 0 else [[] for count in range(0, lengthInfo['count'])]
+                continue
+
+            groupedItems = []
+            itemIdx = 0
+            for length in self.unpackArray(lengthInfo):
+                groupedItems.append(items[itemIdx:itemIdx + length])
+                itemIdx += length
+            items = groupedItems
+        return items[0]
+
+    def __getitem__(self, key):
+        if key in self.overrides: return self.overrides[key]
+        if key in self.removed: raise KeyError(key)
+        if key in self.header['values']: return self.header['values'][key]
+        if key not in self.cache:
+            if key not in self.header['arrays']: raise KeyError(key)
+            self.cache[key] = self.decodeArray(self.header['arrays'][key])
+        return self.cache[key]
+
+    def __setitem__(self, key, value):
+        self.overrides[key] = value
+
+    def __delitem__(self, key):
+        if key not in self: raise KeyError(key)
+        self.overrides.pop(key, None)
+        self.removed.add(key)
+
+    def __iter__(self):
+        keys = set(self.header['values']) | set(self.header['arrays'])
+        keys = (keys - self.removed) | set(self.overrides)
+        return iter(sorted(keys))
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    # Closes the file mapping, which is shared with all copies. Arrays that have
+    # not been decoded before can not be accessed anymore
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Returns a shallow copy sharing the file mapping and the decoded arrays
+    def copy(self):
+        newDict = BinaryFileDict(self.filename, dict(self.overrides), (self.map, self.header, self.dataStart, set(self.removed)))
+        newDict.cache = self.cache
+        return newDict
+
+    # Pickle only the file name and the modified values, so the dict can be passed
+    # between processes without decoding the arrays
+    def __reduce__(self):
+        return (restoreBinaryFileDict, (self.filename, self.overrides, self.removed))
+
+def restoreBinaryFileDict(filename, overrides, removed):
+    binaryDict = BinaryFileDict(filename, overrides)
+    binaryDict.removed = set(removed)
+    return binaryDict